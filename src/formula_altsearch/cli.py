@@ -2,6 +2,7 @@ import argparse
 import difflib
 import logging
 import time
+from collections import defaultdict
 
 from wcwidth import wcwidth
 
@@ -177,12 +178,19 @@ def search(database, composition, excludes=None, raw=False, **opts):
     for match in best_matches:
         match_percentage, combination, dosages = match
 
-        combined_composition = {}
-        for dosage, formula in zip(dosages, combination):
-            for herb, amount in database[formula].items():
-                combined_composition[herb] = combined_composition.get(herb, 0) + dosage * amount
+        compositions = [database[formula] for formula in combination]
+        combined_composition = defaultdict(float)
+        for dosage, formula_composition in zip(dosages, compositions):
+            for herb, amount in formula_composition.items():
+                combined_composition[herb] += dosage * amount
 
-        herbs_amount = sorted(combined_composition.items(), key=lambda item: (item[0] not in target_composition, item[0]))
+        target_items = []
+        other_items = []
+        for item in combined_composition.items():
+            (target_items if item[0] in target_composition else other_items).append(item)
+        target_items.sort()
+        other_items.sort()
+        herbs_amount = target_items + other_items
 
         missing_herbs = {
             herb: amount
@@ -214,12 +222,16 @@ def cmd_search(args):
         print(f'無法載入資料庫檔案: {args.database}')
         return
 
+    if args.jobs > 1 and args.algorithm != 'exhaustive':
+        searcher.log.warning('平行運算僅適用於窮舉演算法，將忽略 --jobs %d', args.jobs)
+
     gen = search(database, args.items, args.excludes, args.raw, top_n=args.num,
                  max_cformulas=args.max_cformulas, max_sformulas=args.max_sformulas,
                  min_cformula_dose=args.min_cformula_dose, min_sformula_dose=args.min_sformula_dose,
                  max_cformula_dose=args.max_cformula_dose, max_sformula_dose=args.max_sformula_dose,
                  penalty_factor=args.penalty, algorithm=args.algorithm,
-                 beam_width_factor=args.beam_width_factor, beam_multiplier=args.beam_multiplier)
+                 beam_width_factor=args.beam_width_factor, beam_multiplier=args.beam_multiplier,
+                 workers=args.jobs)
 
     for msg in gen:
         if msg is not None:
@@ -235,7 +247,7 @@ def cmd_list(args):
         return
 
     if args.raw:
-        names = sorted({k for c in database.values() for k in c})
+        names = sorted(database.herbs)
     else:
         names = sorted(database)
 
@@ -371,6 +383,13 @@ def parse_args(argv=None):
 (預設: %(default)s)""",
     )
 
+    parser_search.add_argument(
+        '-j', '--jobs', metavar='N', default=1,
+        type=bounded_int(1), action='store',
+        help="""平行運算使用的行程數，僅適用於窮舉演算法 (exhaustive)，其他演算法會忽略此值。一般建議設為 CPU 核心數，\
+以加速組合數較多時的運算 (預設: %(default)s)""",
+    )
+
     parser_list = subparsers.add_parser(
         'list', aliases=['l'],
         formatter_class=argparse.RawDescriptionHelpFormatter,
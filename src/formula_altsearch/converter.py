@@ -2,28 +2,55 @@ import csv
 import logging
 import os
 import re
-from decimal import Decimal
+from collections import defaultdict
+from decimal import ROUND_HALF_EVEN, Decimal
 
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 DEFAULT_CONFIG_FILE = os.path.normpath(os.path.join(__file__, '..', 'converter.yaml'))
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
-
-def decimal_representer(dumper, value):
-    s = f'{value:.3f}'.rstrip('0').rstrip('.')
+RE_TYPE = re.compile(r'濃縮顆粒劑')
+RE_ITEM_KEY = re.compile(r'([^”〞"]*)濃縮(?:顆|細)粒', flags=re.M)
+RE_VENDORS = (
+    re.compile(r'“([^”]*)”'),
+    re.compile(r'〝([^〞]*)〞'),
+    re.compile(r'"([^"]*)"'),
+    # handle some bad quote formats
+    re.compile(r'”([^”]*)”'),
+)
+RE_LICENSE_NUM = re.compile(r'\d+')
+RE_UNIT_DOSAGE = re.compile(r'處方:.*?每\s*([\d.]*)\s*(?:gm?\s*)?(?:公?克\s*)?中?含有?')
+RE_COMPOSITION_END = re.compile(r'生藥|製成|浸膏|比例')
+RE_COMPOSITION_BAD_BREAK = re.compile(r'生藥與浸膏')
+RE_COMPOSITION_LINE = re.compile(r'^(.*?)\s*\(([\d.]+)\s*(?:gm?|公?克)\)')
+RE_COMPOSITION_LINE_MG = re.compile(r'^(.*?)\s*\(([\d.]+)\s*mg\)')
+RE_PERCENTAGE = re.compile(r'\s*\([\d.]+%\)$')
+
+
+def number_representer(dumper, value):
+    # round half to even in decimal as Decimal did; 12 significant digits
+    # absorb float errors such as 0.0045 / 3 == 0.0014999999999999998
+    s = str(Decimal(f'{value:.12g}').quantize(Decimal('0.001'), ROUND_HALF_EVEN))
+    s = s.rstrip('0').rstrip('.')
     if '.' not in s:
         s += '.0'
     return dumper.represent_scalar('tag:yaml.org,2002:float', s)
 
 
-class LicenseFileDumper(yaml.SafeDumper):
+class LicenseFileDumper(SafeDumper):
     pass
 
 
-LicenseFileDumper.add_representer(Decimal, decimal_representer)
+LicenseFileDumper.add_representer(float, number_representer)
+LicenseFileDumper.add_representer(Decimal, number_representer)
 
 
 class LicenseFileHandler:
@@ -52,15 +79,23 @@ class LicenseFileHandler:
                 filter_vendor = re.compile(re.escape(filter_vendor), flags=re.M)
 
         data = []
-        reader = csv.DictReader(fh)
-        for row in reader:
+        reader = csv.reader(fh)
+        fieldnames = next(reader, [])
+        for values in reader:
+            # skip blank lines and fill missing fields like csv.DictReader
+            if not values:
+                continue
+            if len(values) < len(fieldnames):
+                values += [None] * (len(fieldnames) - len(values))
+
+            row = dict(zip(fieldnames, values))
             log.debug('處理品項: %s', repr(row['藥品名稱']))
 
             try:
                 self._apply_patch(row)
 
                 type_ = row.get('劑型與類別')
-                if type_ is not None and not re.match(r'濃縮顆粒劑', type_):
+                if type_ is not None and not RE_TYPE.match(type_):
                     continue
 
                 vendor = row.get('藥商名稱').strip() or self.retrieve_vendor_from_name(row['藥品名稱'])
@@ -104,7 +139,7 @@ class LicenseFileHandler:
         return text.split('\n')[0]
 
     def retrieve_item_key(self, text):
-        m = re.search(r'([^”〞"]*)濃縮(?:顆|細)粒', text, flags=re.M)
+        m = RE_ITEM_KEY.search(text)
         if m:
             return self._retrieve_item_key_fix_name(m[1].strip())
 
@@ -115,49 +150,37 @@ class LicenseFileHandler:
         return self.key_remapper.get(name, name)
 
     def retrieve_vendor_from_name(self, text):
-        m = re.search(r'“([^”]*)”', text)
-        if m:
-            return m[1].strip()
-
-        m = re.search(r'〝([^〞]*)〞', text)
-        if m:
-            return m[1].strip()
-
-        m = re.search(r'"([^"]*)"', text)
-        if m:
-            return m[1].strip()
-
-        # handle some bad quote formats
-        m = re.search(r'”([^”]*)”', text)
-        if m:
-            return m[1].strip()
+        for regex in RE_VENDORS:
+            m = regex.search(text)
+            if m:
+                return m[1].strip()
 
         log.warning('無法解析藥品名稱，無法取得藥廠名稱: %s', repr(text))
         return ''
 
     def retrieve_url(self, text):
-        m = re.search(r'\d+', text)
+        m = RE_LICENSE_NUM.search(text)
         num = m[0]
         return f'https://service.mohw.gov.tw/DOCMAP/CusSite/TCMLResultDetail.aspx?LICEWORDID=01&LICENUM={num}'
 
     def retrieve_composition(self, text):
-        comp = {}
+        comp = defaultdict(float)
         lines = text.split('\n')
 
-        m = re.search(r'處方:.*?每\s*([\d.]*)\s*(?:gm?\s*)?(?:公?克\s*)?中?含有?', lines[0])
+        m = RE_UNIT_DOSAGE.search(lines[0])
         if not m:
             raise ValueError(f'無法從第 1 行解析單位克數: {lines[0]!r}')
 
-        unit_dosage = Decimal(m[1]) if m[1] else 1
+        unit_dosage = float(m[1]) if m[1] else 1
 
         for i in range(1, len(lines)):
-            m = re.search(r'生藥|製成|浸膏|比例', lines[i])
+            m = RE_COMPOSITION_END.search(lines[i])
             if m:
                 break
 
             name, dosage = self._retrieve_composition_line(lines, i)
             if name:
-                comp[name] = comp.get(name, 0) + dosage
+                comp[name] += dosage
 
         _i = i + 1
         for i in range(_i, len(lines)):
@@ -165,30 +188,30 @@ class LicenseFileHandler:
                 break
 
             # this may happen due to extra bad line breaking
-            m = re.search(r'生藥與浸膏', lines[i])
+            m = RE_COMPOSITION_BAD_BREAK.search(lines[i])
             if m:
                 continue
 
             name, dosage = self._retrieve_composition_line(lines, i)
             if name:
-                comp[name] = comp.get(name, 0) + dosage
+                comp[name] += dosage
 
-        return comp, unit_dosage
+        return dict(comp), unit_dosage
 
     def _retrieve_composition_line(self, lines, i):
-        m = re.search(r'^(.*?)\s*\(([\d.]+)\s*(?:gm?|公?克)\)', lines[i])
+        m = RE_COMPOSITION_LINE.search(lines[i])
         if m:
-            return self._retrieve_composition_line_fix_name(m[1]), Decimal(m[2])
+            return self._retrieve_composition_line_fix_name(m[1]), float(m[2])
 
-        m = re.search(r'^(.*?)\s*\(([\d.]+)\s*mg\)', lines[i])
+        m = RE_COMPOSITION_LINE_MG.search(lines[i])
         if m:
-            return self._retrieve_composition_line_fix_name(m[1]), Decimal(m[2]) / 1000
+            return self._retrieve_composition_line_fix_name(m[1]), float(m[2]) / 1000
 
         raise ValueError(f'無法從第 {i + 1!r} 行解析組成中藥: {lines[i]!r}')
 
     def _retrieve_composition_line_fix_name(self, name):
         # fix possible percentage info
-        m = re.search(r'\s*\([\d.]+%\)$', name)
+        m = RE_PERCENTAGE.search(name)
         if m:
             name = name[:m.start()]
 
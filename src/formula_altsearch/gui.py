@@ -1,5 +1,6 @@
 import os
 import sys
+from functools import lru_cache
 
 try:
     import gradio as gr
@@ -17,14 +18,31 @@ def get_db_file(dbname):
         return searcher.DEFAULT_DATAFILE
 
 
-def load_db(dbname):
+@lru_cache(maxsize=16)
+def _load_db_file(dbfile, mtime):
+    # mtime is part of the cache key so that an updated file is reloaded
+    return searcher.FormulaDatabase.from_file(dbfile)
+
+
+@lru_cache(maxsize=16)
+def _list_db_file(dbfile, mtime, herbs=False):
+    database = _load_db_file(dbfile, mtime)
+    return '\n'.join(sorted(database.herbs if herbs else database))
+
+
+def _call_db_file(func, dbname, *args):
+    # resolve dbname and convert load failures from func(dbfile, mtime, *args)
     dbfile = get_db_file(dbname)
     try:
-        return searcher.FormulaDatabase.from_file(dbfile)
+        return func(dbfile, os.path.getmtime(dbfile), *args)
     except OSError as exc:
         raise gr.Error(f'無法載入資料庫 "{dbname}": {exc}')
 
 
+def load_db(dbname):
+    return _call_db_file(_load_db_file, dbname)
+
+
 def search(items, raw, excludes,
            max_cformulas, max_sformulas,
            min_cformula_dose, min_sformula_dose,
@@ -77,14 +95,12 @@ def search(items, raw, excludes,
 
 
 def list_formulas(dbname):
-    database = load_db(dbname)
-    value = '\n'.join(sorted(database))
+    value = _call_db_file(_list_db_file, dbname)
     return gr.update(value=value, visible=True)
 
 
 def list_herbs(dbname):
-    database = load_db(dbname)
-    value = '\n'.join(sorted(database.herbs))
+    value = _call_db_file(_list_db_file, dbname, True)
     return gr.update(value=value, visible=True)
 
 
@@ -2,14 +2,35 @@ import heapq
 import logging
 import os
 from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
 from contextlib import nullcontext
 from functools import cached_property
-from itertools import combinations
-from math import ceil, sqrt
+from itertools import islice, product
+from math import ceil, floor, sqrt
+from operator import itemgetter
 
 import numpy as np
 import yaml
-from scipy.optimize import minimize
+from scipy.optimize import lsq_linear
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    def njit(*args, **kwargs):
+        def wrapper(func):
+            return func
+        return wrapper
 
 DEFAULT_DATAFILE = os.path.normpath(os.path.join(__file__, '..', 'database.yaml'))
 
@@ -35,6 +56,102 @@ def find_best_matches(database, target_composition, top_n=None, algorithm='beam'
         raise ValueError(f'未支援此演算法: {algorithm}')
 
 
+@njit(cache=True)
+def solve_bounded_lsq(gram, c, lb, ub, max_iter=100):
+    """求解有上下界的二次規劃 min 1/2 x^T G x - c^T x, lb <= x <= ub
+
+    G = a^T a, c = a^T b 時即等同有界最小平方問題 min ||ax - b||。採用
+    Stark & Parker 的 BVLS 主動集合 (active set) 演算法，但在 n x n 的 G 上運算，
+    變數數 n（組合的方劑數）很小，因此遠比在完整的 a 上求解快。
+
+    回傳 (x, success)，未在 max_iter 次迭代內收斂時 success 為 False。
+    """
+    n = len(c)
+    x = lb.copy()
+    free = np.zeros(n, dtype=np.bool_)
+    tol = 1e-10 * max(1.0, np.max(np.abs(c)))
+
+    for _ in range(max_iter):
+        # w = -gradient; KKT: w <= 0 at lower bound, w >= 0 at upper bound
+        w = c - gram @ x
+        best = -1
+        best_w = tol
+        for j in range(n):
+            if free[j] or lb[j] == ub[j]:
+                continue
+            if x[j] <= lb[j] and w[j] > best_w:
+                best = j
+                best_w = w[j]
+            elif x[j] >= ub[j] and -w[j] > best_w:
+                best = j
+                best_w = -w[j]
+
+        if best < 0:
+            return x, True
+
+        free[best] = True
+
+        while True:
+            idx = np.flatnonzero(free)
+            w = c - gram @ x
+            step = np.linalg.lstsq(gram[idx][:, idx], w[idx], rcond=1e-10)[0]
+            z = x[idx] + step
+
+            alpha = 1.0
+            for t in range(len(idx)):
+                j = idx[t]
+                if z[t] < lb[j]:
+                    alpha = min(alpha, (x[j] - lb[j]) / (x[j] - z[t]))
+                elif z[t] > ub[j]:
+                    alpha = min(alpha, (ub[j] - x[j]) / (z[t] - x[j]))
+
+            if alpha >= 1.0:
+                x[idx] = z
+                break
+
+            # move toward z until hitting a bound, and fix the variables on bounds
+            for t in range(len(idx)):
+                j = idx[t]
+                x[j] += alpha * (z[t] - x[j])
+                if x[j] <= lb[j] + tol:
+                    x[j] = lb[j]
+                    free[j] = False
+                elif x[j] >= ub[j] - tol:
+                    x[j] = ub[j]
+                    free[j] = False
+
+            if not np.any(free):
+                break
+
+    return x, False
+
+
+@njit(cache=True)
+def calculate_gram_delta(x, gram, c, target_sq):
+    """由 G = a^T a, c = a^T b 及 b^T b 計算 ||ax - b||
+
+    ||ax - b||^2 = x^T G x - 2 c^T x + b^T b，計算時不需建構 a。
+    """
+    delta_sq = target_sq
+    for i in range(len(x)):
+        delta_sq -= 2.0 * c[i] * x[i]
+        for j in range(len(x)):
+            delta_sq += x[i] * gram[i, j] * x[j]
+    return sqrt(max(delta_sq, 0.0))
+
+
+_worker_searcher = None
+
+
+def _init_worker(searcher):
+    global _worker_searcher
+    _worker_searcher = searcher
+
+
+def _find_matches_for_combinations(combos):
+    return list(_worker_searcher.find_matches_for_combinations(combos))
+
+
 class FormulaDatabase(dict):
     @classmethod
     def from_file(cls, file):
@@ -46,7 +163,7 @@ class FormulaDatabase(dict):
             _fh = nullcontext(file)
 
         with _fh as fh:
-            data = yaml.safe_load(fh)
+            data = yaml.load(fh, Loader=SafeLoader)
 
         return cls.from_dict(data)
 
@@ -83,26 +200,46 @@ class FormulaDatabase(dict):
         self._compute_formulas()
         return self.__dict__['herbs']
 
+    @cached_property
+    def herb_formulas(self):
+        """各中藥對應到含有該中藥的方劑（依資料庫順序）"""
+        self._compute_formulas()
+        return self.__dict__['herb_formulas']
+
+    @cached_property
+    def formula_order(self):
+        self._compute_formulas()
+        return self.__dict__['formula_order']
+
     def _compute_formulas(self):
         cformulas = {}
         sformulas = {}
         herbs = {}
-        for formula, comp in self.items():
+        herb_formulas = {}
+        formula_order = {}
+        for i, (formula, comp) in enumerate(self.items()):
+            formula_order[formula] = i
             if len(comp) > 1:
                 cformulas[formula] = None
             else:
                 sformulas[formula] = None
             for herb in comp:
                 herbs[herb] = None
+                herb_formulas.setdefault(herb, []).append(formula)
         self.__dict__['cformulas'] = cformulas
         self.__dict__['sformulas'] = sformulas
         self.__dict__['herbs'] = herbs
+        self.__dict__['herb_formulas'] = herb_formulas
+        self.__dict__['formula_order'] = formula_order
 
 
 class FormulaSearcher(ABC):
     DEFAULT_TOP_N = 5
+    EVALUATE_CACHE_SIZE = 65536
 
     def __init__(self, database):
+        if not isinstance(database, FormulaDatabase):
+            database = FormulaDatabase(database)
         self.database = database
 
     def _set_context(
@@ -110,19 +247,26 @@ class FormulaSearcher(ABC):
         max_cformulas=2, max_sformulas=2,
         min_cformula_dose=0.0, min_sformula_dose=0.0,
         max_cformula_dose=50.0, max_sformula_dose=50.0,
-        penalty_factor=2.0, places=1,
+        penalty_factor=2.0, places=1, workers=1,
     ):
         self.target_composition = target_composition
         self.excludes = set() if excludes is None else excludes
+        self.top_n = self.DEFAULT_TOP_N if top_n is None else top_n
         self.max_cformulas = max_cformulas
         self.max_sformulas = max_sformulas
         self.cformula_bounds = (min_cformula_dose, max_cformula_dose)
         self.sformula_bounds = (min_sformula_dose, max_sformula_dose)
         self.penalty_factor = penalty_factor
         self.places = places
+        self.workers = workers
 
-        self.evaluate_cache = {}
+        self.evaluate_cache = OrderedDict()
+        self.evaluate_cache_hits = 0
+        self.evaluate_cache_misses = 0
         self.variance = self.calculate_variance(self.target_composition)
+        self.target_herb_index = {herb: i for i, herb in enumerate(self.target_composition)}
+        self.target_vector = np.fromiter(
+            self.target_composition.values(), dtype=float, count=len(self.target_composition))
 
         self._compute_related_formulas()
 
@@ -130,11 +274,14 @@ class FormulaSearcher(ABC):
         cformulas = {}
         sformulas = {}
         herb_sformulas = {}
-        for item, composition in self.database.items():
-            if item in self.excludes:
-                continue
-            if not any(self.target_composition.get(herb, 0) for herb in composition):
-                continue
+        herb_formulas = self.database.herb_formulas
+        candidates = set()
+        for herb, amount in self.target_composition.items():
+            if amount:
+                candidates.update(herb_formulas.get(herb, ()))
+        candidates.difference_update(self.excludes)
+        for item in sorted(candidates, key=self.database.formula_order.__getitem__):
+            composition = self.database[item]
             if len(composition) > 1:
                 cformulas[item] = None
             else:
@@ -144,11 +291,53 @@ class FormulaSearcher(ABC):
         self.cformulas = cformulas
         self.sformulas = sformulas
         self.herb_sformulas = herb_sformulas
+        self.formula_bits = {}
+        self.target_herb_bits = tuple(
+            (1 << i, amount ** 2, herb in herb_sformulas)
+            for i, (herb, amount) in enumerate(self.target_composition.items())
+        )
+        self.target_herbs = tuple(self.target_composition)
+        self.target_herb_fillable = np.fromiter(
+            (herb in herb_sformulas for herb in self.target_herbs), dtype=bool, count=len(self.target_herbs))
+        self._compute_formula_matrix()
+
+    def _compute_formula_matrix(self):
+        """預先將相關方劑的中藥組成排列為矩陣
+
+        每一欄為一個相關方劑，每一列為一味中藥：前段為目標組成的中藥，後段為相
+        關方劑中出現的非目標組成中藥（其值已乘上 penalty_factor），以便
+        build_dosage_system 直接以欄索引取出子矩陣。
+        """
+        formulas = (*self.cformulas, *self.sformulas)
+        herb_index = dict(self.target_herb_index)
+        rows = []
+        cols = []
+        amounts = []
+        for j, formula in enumerate(formulas):
+            for herb, amount in self.database[formula].items():
+                rows.append(herb_index.setdefault(herb, len(herb_index)))
+                cols.append(j)
+                amounts.append(amount)
+
+        rows = np.array(rows, dtype=np.intp)
+        amounts = np.array(amounts, dtype=float)
+        amounts[rows >= len(self.target_herb_index)] *= self.penalty_factor
+        matrix = np.zeros((len(herb_index), len(formulas)))
+        matrix[rows, cols] = amounts
+
+        target_vector = np.zeros(len(herb_index))
+        target_vector[:len(self.target_vector)] = self.target_vector
+
+        self.formula_index = {formula: j for j, formula in enumerate(formulas)}
+        self.formula_matrix = matrix
+        self.formula_gram = matrix.T @ matrix
+        self.formula_target_dot = matrix.T @ target_vector
+        self.target_sq = float(self.target_vector @ self.target_vector)
 
     def find_best_matches(self, top_n=None, *args, **kwargs):
         top_n = self.DEFAULT_TOP_N if top_n is None else top_n
         gen = self.find_unique_matches(*args, top_n=top_n, **kwargs)
-        matches = heapq.nlargest(top_n, gen, key=lambda x: x[0])
+        matches = heapq.nlargest(top_n, gen, key=itemgetter(0))
         return matches
 
     def find_unique_matches(self, *args, **kwargs):
@@ -168,36 +357,115 @@ class FormulaSearcher(ABC):
             log.debug('輸出: %s %s (%.2f%%)', combo, dosages, match_pct)
             yield match_pct, combo, dosages
 
+        log.debug('精算快取: 命中 %i; 未命中 %i', self.evaluate_cache_hits, self.evaluate_cache_misses)
+
     def find_matches(self):
-        for combo in self.generate_combinations():
+        yield from self.find_matches_for_combinations(self.generate_combinations())
+
+    def find_matches_for_combinations(self, combos):
+        # a combo may reduce to an evaluated one after removing 0-dosage formulas,
+        # which would yield the same extended combos again
+        seen = set()
+        for combo in combos:
             if combo:
                 try:
                     combo, dosages, match_pct = self.evaluate_combination(combo)
                 except ValueError as exc:
-                    log.debug('略過錯誤項目: %s', combo, exc)
+                    log.debug('略過錯誤項目: %s: %s', combo, exc)
                     continue
             else:
                 dosages = ()
 
+            key = frozenset(combo)
+            if key in seen:
+                log.debug('略過重複項目: %s', combo)
+                continue
+            seen.add(key)
+
             for extended_combo in self.generate_combinations_for_sformulas(combo, dosages):
                 if extended_combo != combo:
+                    if self._is_prunable_extension(extended_combo):
+                        log.debug('剪枝: %s', extended_combo)
+                        continue
                     try:
                         extended_combo, dosages, match_pct = self.evaluate_combination(extended_combo)
                     except ValueError as exc:
-                        log.debug('略過錯誤項目: %s', extended_combo, exc)
+                        log.debug('略過錯誤項目: %s: %s', extended_combo, exc)
                         continue
                 yield match_pct, extended_combo, dosages
 
+    def _is_prunable_extension(self, combo):
+        """判斷已補上單方的組合是否可略過評估"""
+        return False
+
     @abstractmethod
     def generate_combinations(self):
         pass
 
+    def calculate_delta_lower_bound(self, combo):
+        """估算組合（含後續補上的單方）可達到的最小差異值下限
+
+        組合中所有方劑都不含的目標中藥，其殘差必等於目標劑量；其中有對應單方者
+        可能在後續補上單方時被填補，因此扣除其中劑量最大的 max_sformulas 味。
+        所得值不大於此組合及其任何單方擴展組合的實際差異值，可安全用於剪枝。
+        """
+        covered = 0
+        for formula in combo:
+            covered |= self.get_formula_bits(formula)
+        return self._calculate_delta_lower_bound(covered)
+
+    def _calculate_delta_lower_bound(self, covered):
+        uncovered = []
+        fillable = []
+        for bit, amount_sq, is_fillable in self.target_herb_bits:
+            if covered & bit:
+                continue
+            if is_fillable:
+                fillable.append(amount_sq)
+            else:
+                uncovered.append(amount_sq)
+
+        if self.max_sformulas > 0:
+            fillable = heapq.nsmallest(max(len(fillable) - self.max_sformulas, 0), fillable)
+
+        return sqrt(sum(uncovered) + sum(fillable))
+
+    def get_formula_bits(self, formula):
+        """取得方劑所含目標組成中藥的位元集合（第 i 位對應目標組成的第 i 味中藥）"""
+        try:
+            return self.formula_bits[formula]
+        except KeyError:
+            pass
+
+        bits = 0
+        for herb in self.database[formula]:
+            try:
+                bits |= 1 << self.target_herb_index[herb]
+            except KeyError:
+                pass
+        self.formula_bits[formula] = bits
+        return bits
+
     def get_formula_composition(self, formulas, dosages):
-        composition = {}
+        composition = defaultdict(float)
         for formula, dosage in zip(formulas, dosages):
             for herb, amount in self.database[formula].items():
-                composition[herb] = composition.get(herb, 0) + amount * dosage
-        return composition
+                composition[herb] += amount * dosage
+        return dict(composition)
+
+    def get_remaining_amounts(self, combo, dosages):
+        """計算目標組成各中藥扣除組合劑量後的剩餘量，依目標組成的順序排列"""
+        dosages = np.asarray(dosages, dtype=float)
+        cols = self._get_formula_columns(combo)
+        if cols is not None:
+            n = len(self.target_vector)
+            return self.target_vector - self.formula_matrix[:n, cols] @ dosages
+
+        combined_composition = self.get_formula_composition(combo, dosages)
+        return np.fromiter(
+            (amount - combined_composition.get(herb, 0) for herb, amount in self.target_composition.items()),
+            dtype=float, count=len(self.target_composition),
+        )
 
     def calculate_variance(self, composition):
         return sqrt(sum(amount**2 for amount in composition.values()))
@@ -211,14 +479,9 @@ class FormulaSearcher(ABC):
 
         非目標組成的中藥其貢獻度另外乘上 penalty_factor。
 
-        註：亦可改為以 delta^2 作為最小化目標，此即殘差平方和 (sum of squared
-        residuals, SSR)，可於迭代時省略開平方的開銷，且有專門最佳化過的
-        scipy.optimize.lsq_linear 函數及演算法可利用，但須全面把數據向量化，代
-        價是記憶體開銷較大（大約為資料庫總方劑數 * 總中藥數 * N），且需全面改
-        用較難理解的矩陣運算，考量實務上 beam search 速度已夠快，暫無必要進一
-        步最佳化。目前實測 scipy.optimize.minimize 處理 delta 比 SSR 快，可能
-        是對此演算法而言一次函數在目標值附近比較容易估算梯度所致，因此這裡仍採
-        用 delta。
+        註：delta^2 即殘差平方和 (sum of squared residuals, SSR)，為劑量的二次
+        函數，因此求最佳劑量時改用 build_dosage_system 建構的線性系統，以
+        scipy.optimize.lsq_linear 求解，此函數僅供驗算或計算任意劑量的差異值。
         """
         target = self.target_composition if target_composition is None else target_composition
         combined_composition = self.get_formula_composition(combo, x)
@@ -234,22 +497,96 @@ class FormulaSearcher(ABC):
 
         return sqrt(delta)
 
-    def find_best_dosages(self, combo, target_composition=None, *, initial_guess=None,
-                          bounds=None, options=None):
-        initial_guess = np.ones(len(combo)) if initial_guess is None else initial_guess
+    def build_dosage_system(self, combo, target_composition=None):
+        """建構求解最佳劑量的線性系統 a, b
+
+        矩陣 a 的每一欄為一個方劑的中藥組成，每一列對應一味中藥：前段為目標組成的
+        中藥，後段為組合中出現的非目標組成中藥（其值乘上 penalty_factor）；b 為
+        目標劑量，非目標組成中藥的目標劑量為 0。如此 ||ax - b|| 即等於
+        calculate_delta 所得的差異值。
+        """
+        if target_composition is None:
+            try:
+                cols = [self.formula_index[f] for f in combo]
+            except KeyError:
+                pass
+            else:
+                n = len(self.target_vector)
+                a = self.formula_matrix[:, cols]
+                # drop non-target herbs not present in any formula of the combo
+                a = np.concatenate((a[:n], a[n:][np.any(a[n:], axis=1)]))
+                b = np.zeros(len(a))
+                b[:n] = self.target_vector
+                return a, b
+
+            herb_index = self.target_herb_index
+            target_vector = self.target_vector
+        else:
+            herb_index = {herb: i for i, herb in enumerate(target_composition)}
+            target_vector = np.fromiter(target_composition.values(), dtype=float, count=len(target_composition))
+
+        extra_index = {}
+        entries = []
+        for j, formula in enumerate(combo):
+            for herb, amount in self.database[formula].items():
+                try:
+                    i = herb_index[herb]
+                except KeyError:
+                    i = len(herb_index) + extra_index.setdefault(herb, len(extra_index))
+                    amount *= self.penalty_factor
+                entries.append((i, j, amount))
+
+        a = np.zeros((len(herb_index) + len(extra_index), len(combo)))
+        for i, j, amount in entries:
+            a[i, j] += amount
+
+        b = np.zeros(len(herb_index) + len(extra_index))
+        b[:len(target_vector)] = target_vector
+
+        return a, b
+
+    def find_best_dosages(self, combo, target_composition=None, *, bounds=None):
+        """求解使差異值最小的最佳劑量
+
+        差異值平方為劑量的二次函數，因此可視為有上下界的線性最小平方問題
+        (bounded-variable least squares, BVLS)，直接求得精確解而不需迭代逼近。
+
+        組合中的方劑皆為相關方劑時，以預先計算的 formula_gram 取出 G = a^T a，
+        交由 solve_bounded_lsq 求解；否則（或未收斂時）建構完整的線性系統交由
+        scipy.optimize.lsq_linear 求解。
+        """
         bounds = [
             self.sformula_bounds if f in self.sformulas else self.cformula_bounds
             for f in combo
         ] if bounds is None else bounds
-        options = {
-            'ftol': 10 ** (-self.places - 2),
-            'disp': False,
-        } if options is None else options
-        result = minimize(self.calculate_delta, initial_guess, args=(combo, target_composition),
-                          method='SLSQP', bounds=bounds, options=options)
+        lb, ub = np.array(bounds, dtype=float).T
+
+        if target_composition is None:
+            cols = self._get_formula_columns(combo)
+            if cols is not None:
+                gram = self.formula_gram[cols[:, None], cols]
+                c = self.formula_target_dot[cols]
+                if len(cols) == 1 and gram[0, 0] > 0:
+                    # a single formula: clipping the 1-D optimum is exact
+                    x = np.clip(c / gram[0], lb, ub)
+                    success = True
+                else:
+                    x, success = solve_bounded_lsq(gram, c, lb, ub)
+                if success:
+                    return x, calculate_gram_delta(x, gram, c, self.target_sq)
+                log.debug('BVLS 未收斂，改用 lsq_linear: %s', combo)
+
+        a, b = self.build_dosage_system(combo, target_composition)
+        result = lsq_linear(a, b, bounds=(lb, ub), method='bvls')
         if not result.success:
             raise ValueError(f'Unable to find best dosages: {result.message}')
-        return result.x, result.fun
+        return result.x, float(np.linalg.norm(result.fun))
+
+    def _get_formula_columns(self, combo):
+        try:
+            return np.array([self.formula_index[f] for f in combo], dtype=np.intp)
+        except KeyError:
+            return None
 
     def calculate_match_ratio(self, delta, variance=None):
         """將待測劑量組成與目標劑量組成的差異值轉化為匹配度
@@ -265,45 +602,63 @@ class FormulaSearcher(ABC):
         variance = self.variance if variance is None else variance
         return (1.0 - delta / variance) if variance != 0 else 1.0
 
-    def calculate_match(self, combo, **opts):
+    def calculate_match(self, combo):
         key = frozenset(combo)
         try:
-            result = self.evaluate_cache[key]
+            cached_combo, result = self.evaluate_cache[key]
         except KeyError:
-            result = None
+            cached_combo, result = combo, None
 
         if result is None:
+            self.evaluate_cache_misses += 1
             log.debug('精算: %s', combo)
             if combo:
                 try:
-                    result = self._calculate_match(combo, **opts)
+                    result = self._calculate_match(combo)
                 except ValueError as exc:
                     log.debug('無法計算匹配劑量: %s: %s', combo, exc)
                     result = exc
             else:
                 result = (), 0.0, 100.0
 
-            self.evaluate_cache[key] = result
+            self.evaluate_cache[key] = combo, result
+            if len(self.evaluate_cache) > self.EVALUATE_CACHE_SIZE:
+                self.evaluate_cache.popitem(last=False)
+        else:
+            self.evaluate_cache_hits += 1
+            self.evaluate_cache.move_to_end(key)
 
         if isinstance(result, Exception):
             raise result
 
+        # the cached dosages are ordered as the combo that was first evaluated
+        if cached_combo != combo:
+            dosages, delta, match_pct = result
+            dosage_map = dict(zip(cached_combo, dosages))
+            result = np.array([dosage_map[f] for f in combo]), delta, match_pct
+
         return result
 
-    def _calculate_match(self, combo, target_composition=None, **opts):
-        dosages, delta = self.find_best_dosages(combo, target_composition, **opts)
+    def _calculate_match(self, combo, target_composition=None):
+        dosages, delta = self.find_best_dosages(combo, target_composition)
         _dosages = np.round(dosages, self.places)
         if not np.array_equal(_dosages, dosages):
             dosages = _dosages
-            delta = self.calculate_delta(dosages, combo, target_composition)
+            cols = None if target_composition is not None else self._get_formula_columns(combo)
+            if cols is not None:
+                gram = self.formula_gram[cols[:, None], cols]
+                delta = calculate_gram_delta(dosages, gram, self.formula_target_dot[cols], self.target_sq)
+            else:
+                a, b = self.build_dosage_system(combo, target_composition)
+                delta = float(np.linalg.norm(a @ dosages - b))
         variance = (None if target_composition is None
                     else self.calculate_variance(target_composition))
         match_pct = self.calculate_match_ratio(delta, variance) * 100
         return dosages, delta, match_pct
 
-    def evaluate_combination(self, combo, *, initial_guess=None):
+    def evaluate_combination(self, combo):
         # raise ValueError if unable to find minimal dosages
-        dosages, delta, match_pct = self.calculate_match(combo, initial_guess=initial_guess)
+        dosages, delta, match_pct = self.calculate_match(combo)
         log.debug('估值: %s %s: %.3f (%.2f%%)', combo, dosages, delta, match_pct)
 
         # remove formulas with 0 dosage
@@ -316,46 +671,155 @@ class FormulaSearcher(ABC):
             if np.all(non_zero_mask):
                 break
 
-            fixed_combo = tuple(np.array(fixed_combo, dtype=object)[non_zero_mask])
+            fixed_combo = tuple(f for f, non_zero in zip(fixed_combo, non_zero_mask) if non_zero)
             fixed_dosages = fixed_dosages[non_zero_mask]
-            fixed_dosages, delta, match_pct = self.calculate_match(fixed_combo, initial_guess=fixed_dosages)
+            fixed_dosages, delta, match_pct = self.calculate_match(fixed_combo)
 
         log.debug('校正: %s %s: %.3f (%.2f%%)', fixed_combo, np.round(fixed_dosages, self.places), delta, match_pct)
 
         return fixed_combo, fixed_dosages, match_pct
 
     def generate_combinations_for_sformulas(self, combo, dosages):
-        combined_composition = self.get_formula_composition(combo, dosages)
-        remaining_composition = {
-            herb: amount - combined_composition.get(herb, 0)
-            for herb, amount in self.target_composition.items()
-        }
-
-        weighted_herbs = sorted(remaining_composition.items(), key=lambda item: -item[1])
-        candidate_herbs = tuple(
-            herb for herb, amount in weighted_herbs
-            if herb in self.herb_sformulas and np.round(amount, self.places) > 0
-        )
-        candidate_herbs_count = len(candidate_herbs)
-
-        stack = [(0, combo)]
-        while stack:
-            n, combo = stack.pop()
-            if n >= self.max_sformulas or n >= candidate_herbs_count:
-                if combo:
-                    yield combo
-                continue
+        remaining_amounts = self.get_remaining_amounts(combo, dosages)
+        order = np.argsort(-remaining_amounts, kind='stable')
+        order = order[self.target_herb_fillable[order] & (np.round(remaining_amounts[order], self.places) > 0)]
+        candidate_herbs = tuple(self.target_herbs[i] for i in order[:self.max_sformulas])
 
-            herb = candidate_herbs[n]
-            for sformula in reversed(self.herb_sformulas[herb]):
-                stack.append((n + 1, combo + (sformula,)))
+        if not candidate_herbs:
+            if combo:
+                yield combo
+            return
+
+        for sformulas in product(*(self.herb_sformulas[herb] for herb in candidate_herbs)):
+            yield combo + sformulas
 
 
 class ExhaustiveFormulaSearcher(FormulaSearcher):
+    CHUNK_SIZE = 256
+
+    def _set_context(self, *args, **kwargs):
+        super()._set_context(*args, **kwargs)
+        # match_pct of the current top_n unique matches, for pruning
+        self.top_matches = []
+
+    def find_unique_matches(self, *args, **kwargs):
+        for item in super().find_unique_matches(*args, **kwargs):
+            match_pct = item[0]
+            if len(self.top_matches) < self.top_n:
+                heapq.heappush(self.top_matches, match_pct)
+            elif self.top_matches and match_pct > self.top_matches[0]:
+                heapq.heapreplace(self.top_matches, match_pct)
+            yield item
+
+    def find_matches(self):
+        if self.workers > 1:
+            return self.find_matches_parallel()
+        return super().find_matches()
+
+    def find_matches_parallel(self):
+        """以多個行程平行評估組合
+
+        組合依 CHUNK_SIZE 分批送交子行程評估，且同時處理中的批次數有上限，以便
+        剪枝時能利用已取得的評估結果。
+        """
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self,)) as executor:
+            pending = set()
+            gen = self.generate_combinations()
+            while chunk := list(islice(gen, self.CHUNK_SIZE)):
+                pending.add(executor.submit(_find_matches_for_combinations, chunk))
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+
+            for future in as_completed(pending):
+                yield from future.result()
+
     def generate_combinations(self):
-        for i in range(0, min(len(self.cformulas), self.max_cformulas) + 1):
-            for c in combinations(self.cformulas, i):
-                yield c
+        formulas = tuple(self.cformulas)
+        for i in range(0, min(len(formulas), self.max_cformulas) + 1):
+            for indexes in self._generate_index_combinations(len(formulas), i):
+                yield tuple(formulas[j] for j in indexes)
+
+    def _generate_index_combinations(self, count, size):
+        """依 itertools.combinations(range(count), size) 的順序產生未被剪枝的組合
+
+        以深度優先展開前綴，並逐步累計前綴涵蓋的目標中藥位元及非目標中藥懲罰。
+        前綴加上其後所有方劑的涵蓋位元仍無法進入前 top_n 名時，略過整個子樹；
+        子樹的下限不大於其中任一組合的下限，因此所產生的組合與逐一剪枝相同。
+        """
+        formulas = tuple(islice(self.cformulas, count))
+        formula_bits = tuple(self.get_formula_bits(f) for f in formulas)
+        debug = log.isEnabledFor(logging.DEBUG)
+        suffix_bits = [0] * (count + 1)
+        for j in reversed(range(count)):
+            suffix_bits[j] = suffix_bits[j + 1] | formula_bits[j]
+
+        # each cformula takes at least the min dose, so its non-target herbs
+        # contribute at least that much penalty, which no sformula can cancel;
+        # a dosage may still be rounded to places below the min dose, so bound
+        # by the lowest one that can survive rounding
+        scale = 10 ** self.places
+        min_dose = floor(self.cformula_bounds[0] * scale) / scale
+        if min_dose > 0:
+            n = len(self.target_vector)
+            nontargets = np.ascontiguousarray(min_dose * self.formula_matrix[n:, :count].T)
+        else:
+            nontargets = None
+
+        def dfs(prefix, covered, nontarget):
+            depth = len(prefix)
+            if depth == size:
+                if self._is_prunable(covered, nontarget):
+                    if debug:
+                        log.debug('剪枝: %s', tuple(formulas[k] for k in prefix))
+                    return
+                yield prefix
+                return
+
+            start = prefix[-1] + 1 if prefix else 0
+            for j in range(start, count - (size - depth) + 1):
+                _covered = covered | formula_bits[j]
+                _nontarget = None if nontargets is None else (
+                    nontargets[j] if nontarget is None else nontarget + nontargets[j])
+                if depth + 1 < size and self._is_prunable(_covered | suffix_bits[j + 1], _nontarget):
+                    if debug:
+                        log.debug('剪枝子樹: %s', tuple(formulas[k] for k in prefix + (j,)))
+                    continue
+                yield from dfs(prefix + (j,), _covered, _nontarget)
+
+        yield from dfs((), 0, None)
+
+    def _is_prunable(self, covered, nontarget=None):
+        """判斷組合的匹配度上限是否已不可能進入目前的前 top_n 名
+
+        covered 為組合涵蓋的目標中藥位元集合；nontarget 為組合中各複方以最小劑量
+        計算的非目標中藥懲罰量（None 表示不計）。
+        """
+        if not self.top_matches or len(self.top_matches) < self.top_n:
+            return False
+
+        delta = self._calculate_delta_lower_bound(covered)
+        if self.calculate_match_ratio(delta) * 100 <= self.top_matches[0]:
+            return True
+
+        if nontarget is not None:
+            delta = sqrt(delta ** 2 + nontarget @ nontarget)
+            return self.calculate_match_ratio(delta) * 100 <= self.top_matches[0]
+
+        return False
+
+    def _is_prunable_extension(self, combo):
+        # the extended combo is final, so no uncovered target herb can be filled anymore
+        if not self.top_matches or len(self.top_matches) < self.top_n:
+            return False
+
+        covered = 0
+        for formula in combo:
+            covered |= self.get_formula_bits(formula)
+        delta = sqrt(sum(amount_sq for bit, amount_sq, _ in self.target_herb_bits if not covered & bit))
+        max_match_pct = self.calculate_match_ratio(delta) * 100
+        return max_match_pct <= self.top_matches[0]
 
 
 class BeamFormulaSearcher(FormulaSearcher):
@@ -369,6 +833,12 @@ class BeamFormulaSearcher(FormulaSearcher):
         self.beam_width = max(ceil(beam_width_factor * top_n), 1)
         self.beam_multiplier = beam_multiplier
 
+        # cformulas are the leading columns of formula_matrix
+        count = len(self.cformulas)
+        self.cformula_names = tuple(self.cformulas)
+        self.formula_target_matrix = np.ascontiguousarray(self.formula_matrix[:len(self.target_vector), :count].T)
+        self.formula_norms = np.sqrt(np.diag(self.formula_gram)[:count])
+
     def find_matches(self):
         for match_pct, combo, dosages in self.generate_combinations():
             for extended_combo in self.generate_combinations_for_sformulas(combo, dosages):
@@ -376,7 +846,7 @@ class BeamFormulaSearcher(FormulaSearcher):
                     try:
                         extended_combo, dosages, match_pct = self.evaluate_combination(extended_combo)
                     except ValueError as exc:
-                        log.debug('略過錯誤項目: %s', extended_combo, exc)
+                        log.debug('略過錯誤項目: %s: %s', extended_combo, exc)
                         continue
                 yield match_pct, extended_combo, dosages
 
@@ -387,7 +857,7 @@ class BeamFormulaSearcher(FormulaSearcher):
                 candidates = heapq.nlargest(
                     self.beam_width,
                     self.generate_unique_combinations_at_depth(depth, candidates),
-                    key=lambda x: x[1],
+                    key=itemgetter(1),
                 )
                 log.debug('第 %i 層候選: %s', depth, [x[2] for x in candidates])
             else:
@@ -433,14 +903,12 @@ class BeamFormulaSearcher(FormulaSearcher):
             else:
                 gen = self.generate_ramaining_candidates(combo)
 
-            _new_dosages = np.append(dosages, (1.0,))
             for formula in gen:
                 new_combo = combo + (formula,)
                 try:
-                    new_combo, new_dosages, match_pct = self.evaluate_combination(
-                        new_combo, initial_guess=_new_dosages)
+                    new_combo, new_dosages, match_pct = self.evaluate_combination(new_combo)
                 except ValueError as exc:
-                    log.debug('略過錯誤項目: %s', new_combo, exc)
+                    log.debug('略過錯誤項目: %s: %s', new_combo, exc)
                     continue
 
                 new_item = depth + 1, match_pct, new_combo, new_dosages
@@ -451,68 +919,48 @@ class BeamFormulaSearcher(FormulaSearcher):
         return (f for f in self.cformulas if f not in combo_set)
 
     def generate_heuristic_candidates(self, combo, dosages, quota):
-        remaining_map = self._calculate_remaining_map(combo, dosages)
-        log.debug('剩餘組成比: %s', remaining_map)
-        if not remaining_map:
+        remaining_amounts = self._calculate_remaining_amounts(combo, dosages)
+        log.debug('剩餘組成: %s', remaining_amounts)
+        if not remaining_amounts.any():
             log.debug('略過擴展: %s', combo)
             return
 
-        candidate_formulas = heapq.nlargest(
-            quota,
-            self.generate_ramaining_candidates(combo),
-            key=lambda f: self._calculate_formula_score(f, remaining_map),
-        )
-
-        for formula in candidate_formulas:
-            log.debug('快捷輸出: %s', formula)
+        scores = self._calculate_formula_scores(remaining_amounts)
+        mask = np.ones(len(scores), dtype=bool)
+        for formula in combo:
+            j = self.formula_index.get(formula)
+            if j is not None and j < len(mask):
+                mask[j] = False
+        candidates = np.flatnonzero(mask)
+
+        # stable sort keeps the cformula order for ties, like heapq.nlargest
+        order = np.argsort(-scores[candidates], kind='stable')[:quota]
+        for j in candidates[order]:
+            formula = self.cformula_names[j]
+            log.debug('快捷輸出: %s (%.3f)', formula, scores[j])
             yield formula
 
-    def _calculate_remaining_map(self, combo, dosages):
-        combined_composition = self.get_formula_composition(combo, dosages)
-        remaining_composition = {
-            herb: fixed_amount
-            for herb, amount in self.target_composition.items()
-            if (fixed_amount := np.round(amount - combined_composition.get(herb, 0), self.places)) > 0
-        }
-        total = sum(remaining_composition.values())
-        return {
-            herb: amount / total
-            for herb, amount in remaining_composition.items()
-        }
-
-    def _calculate_formula_score(self, formula, remaining_map):
-        """計算複方評分，以估算其是否適合填補目前的剩餘中藥組成
-
-        評分方式為餘弦相似性 (cosine similarity)：將待測中藥組成與目標中藥組成
+    def _calculate_remaining_amounts(self, combo, dosages):
+        """計算各目標中藥的剩餘劑量，依 places 捨入，已超出者視為 0"""
+        remaining_amounts = np.round(self.get_remaining_amounts(combo, dosages), self.places)
+        remaining_amounts[remaining_amounts < 0] = 0.0
+        return remaining_amounts
+
+    def _calculate_formula_scores(self, remaining_amounts):
+        """計算各複方的評分，以估算其是否適合填補目前的剩餘中藥組成
+
+        評分方式為餘弦相似性 (cosine similarity)：將待測中藥組成與剩餘中藥組成
         分別視為多維空間中二個從原點出發的向量 OA(a1, a2, a3, ...),
         OB(b1, b2, b3, ...)，計算向量 OA 與向量 OB 的夾角。值為 1 表示二者夾角
         為 0 度，此時此複方（按特定比例縮放後）可完美填補剩餘中藥組成；值為 0
         表示二者夾角為 90 度，此時此複方不可能填補剩餘中藥組成。
 
-        餘弦相似性與數值大小無關，用「劑量組成」或「劑量組成比」皆可計算，理論上
-        前者可省略把劑量轉換成比例的運算，但實測後者較快，可能是因後者的值固定在
-        0~1，浮點數運算在底層處理器較易最佳化所致。
+        餘弦相似性與數值大小無關，因此直接以剩餘中藥劑量及 formula_matrix（非目標
+        組成已乘上 penalty_factor）計算，一次求得所有複方的評分，回傳值依
+        cformula_names 排列。
         """
-        composition = self.database[formula]
-        herbs = set(composition)
-        herbs.update(remaining_map)
-
-        try:
-            total = sum(composition.values())
-            sum_ab = 0.0
-            sum_a_sq = 0.0
-            sum_b_sq = 0.0
-            for herb in herbs:
-                a = composition.get(herb, 0.0) / total
-                if herb not in self.target_composition:
-                    a *= self.penalty_factor
-                b = remaining_map.get(herb, 0.0)
-                sum_ab += a * b
-                sum_a_sq += a ** 2.0
-                sum_b_sq += b ** 2.0
-            score = sum_ab / (sqrt(sum_a_sq) * sqrt(sum_b_sq))
-        except ZeroDivisionError:
-            return 0.0
-
-        log.debug('快捷估值: %s: %.3f', formula, score)
-        return score
+        numerators = self.formula_target_matrix @ remaining_amounts
+        denominators = self.formula_norms * np.linalg.norm(remaining_amounts)
+        scores = np.zeros(len(numerators))
+        np.divide(numerators, denominators, out=scores, where=denominators > 0)
+        return scores
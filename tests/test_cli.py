@@ -31,6 +31,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -42,6 +43,7 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=3,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
 
     @mock.patch('sys.stdout', new_callable=StringIO)
@@ -65,6 +67,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -76,9 +79,41 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=3,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
         self.assertRegex(m_stdout.getvalue(), r'資料庫尚未收錄')
 
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(cli.searcher, 'log')
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE)
+    def test_cmd_search_jobs_ignored(self, m_load, m_log, m_stdout):
+        args = SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            items=[('桂枝湯', 3)],
+            raw=False,
+            algorithm='beam',
+            max_cformulas=2,
+            max_sformulas=3,
+            min_cformula_dose=1.0,
+            min_sformula_dose=0.3,
+            max_cformula_dose=50.0,
+            max_sformula_dose=50.0,
+            penalty=3,
+            num=6,
+            excludes=[],
+            beam_width_factor=0.5,
+            beam_multiplier=2.0,
+            jobs=4,
+        )
+        cli.cmd_search(args)
+        m_log.warning.assert_called_once_with('平行運算僅適用於窮舉演算法，將忽略 --jobs %d', 4)
+
+        m_log.reset_mock()
+        args.algorithm = 'exhaustive'
+        cli.cmd_search(args)
+        m_log.warning.assert_not_called()
+
     @mock.patch('sys.stdout', new_callable=StringIO)
     @mock.patch.object(cli, 'search', wraps=cli.search)
     @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE)
@@ -100,6 +135,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -111,6 +147,7 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=3,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
 
     @mock.patch('sys.stdout', new_callable=StringIO)
@@ -134,6 +171,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -145,6 +183,7 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=3,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
         self.assertRegex(m_stdout.getvalue(), r'資料庫尚未收錄')
 
@@ -169,6 +208,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -180,6 +220,7 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=5,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
 
     @mock.patch('sys.stdout', new_callable=StringIO)
@@ -203,6 +244,7 @@ class TestCmdSearch(unittest.TestCase):
             excludes=[],
             beam_width_factor=0.5,
             beam_multiplier=2.0,
+            jobs=1,
         ))
         m_load.assert_called_once_with('custom_db.yaml')
         m_search.assert_called_once_with(
@@ -214,6 +256,7 @@ class TestCmdSearch(unittest.TestCase):
             penalty_factor=5,
             algorithm='exhaustive',
             beam_width_factor=0.5, beam_multiplier=2.0,
+            workers=1,
         )
         self.assertRegex(m_stdout.getvalue(), r'資料庫尚未收錄')
 
@@ -64,13 +64,13 @@ class TestLicenseFileHandler(unittest.TestCase):
                 'key': '桂枝湯',
                 'vendor': '張三製藥股份有限公司',
                 'url': 'https://service.mohw.gov.tw/DOCMAP/CusSite/TCMLResultDetail.aspx?LICEWORDID=01&LICENUM=000000',
-                'unit_dosage': Decimal('12'),
+                'unit_dosage': 12.0,
                 'composition': {
-                    '桂枝': Decimal('6.0'),
-                    '白芍': Decimal('6.0'),
-                    '炙甘草': Decimal('4.0'),
-                    '生薑': Decimal('6.0'),
-                    '大棗': Decimal('5.0'),
+                    '桂枝': 6.0,
+                    '白芍': 6.0,
+                    '炙甘草': 4.0,
+                    '生薑': 6.0,
+                    '大棗': 5.0,
                 },
             },
         ])
@@ -86,11 +86,11 @@ class TestLicenseFileHandler(unittest.TestCase):
                 'vendor': '張三製藥股份有限公司',
                 'url': 'https://service.mohw.gov.tw/DOCMAP/CusSite/TCMLResultDetail.aspx?LICEWORDID=01&LICENUM=000000',
                 'composition': {
-                    '桂枝': Decimal('0.5'),
-                    '白芍': Decimal('0.5'),
-                    '炙甘草': Decimal('0.3333333333333333333333333333'),
-                    '生薑': Decimal('0.5'),
-                    '大棗': Decimal('0.4166666666666666666666666667'),
+                    '桂枝': 0.5,
+                    '白芍': 0.5,
+                    '炙甘草': 4.0 / 12,
+                    '生薑': 0.5,
+                    '大棗': 5.0 / 12,
                 },
             },
         ])
@@ -240,3 +240,60 @@ class TestLicenseFileHandler(unittest.TestCase):
                 大棗: 0.417
             """
         ))
+
+    def test_dump_float(self):
+        data = [
+            {
+                'name': '“張三”桂枝湯濃縮細粒',
+                'key': '桂枝湯',
+                'unit_dosage': 12.0,
+                'composition': {
+                    '桂枝': 6.0,
+                    '炙甘草': 4.0 / 12,
+                    '大棗': 0.1 + 0.2,
+                },
+            },
+        ]
+
+        fh = StringIO()
+        handler = converter.LicenseFileHandler()
+        handler._dump(data, fh, indent=2)
+        self.assertEqual(fh.getvalue(), dedent(
+            """\
+            - name: “張三”桂枝湯濃縮細粒
+              key: 桂枝湯
+              unit_dosage: 12.0
+              composition:
+                桂枝: 6.0
+                炙甘草: 0.333
+                大棗: 0.3
+            """
+        ))
+
+    def test_dump_round_half_even(self):
+        handler = converter.LicenseFileHandler()
+        composition, unit_dosage = handler.retrieve_composition(dedent(
+            """\
+            處方:每 3 公克中含有
+            甘草 (12.5 mg)
+            黃耆 (0.0045 g)
+            以上生藥製成
+            """
+        ))
+        data = [
+            {'composition': composition},
+            {'composition': {herb: dosage / unit_dosage for herb, dosage in composition.items()}},
+        ]
+
+        fh = StringIO()
+        handler._dump(data, fh, indent=2)
+        self.assertEqual(fh.getvalue(), dedent(
+            """\
+            - composition:
+                甘草: 0.012
+                黃耆: 0.004
+            - composition:
+                甘草: 0.004
+                黃耆: 0.002
+            """
+        ))
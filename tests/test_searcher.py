@@ -1,9 +1,11 @@
 import unittest
 from io import StringIO
+from math import sqrt
 from textwrap import dedent
 from unittest import mock
 
 import numpy as np
+from scipy.optimize import lsq_linear
 
 from formula_altsearch import searcher as _searcher
 
@@ -15,6 +17,45 @@ class TestUtilities(unittest.TestCase):
         m_cls.assert_called_with({})
         m_cls().find_best_matches.assert_called_with(None, {}, excludes=None, penalty_factor=2.0)
 
+    def test_solve_bounded_lsq(self):
+        """Should get the same optimum as `scipy.optimize.lsq_linear`."""
+        a = np.array([
+            [1.0, 0.0, 1.0],
+            [1.0, 1.0, 1.0],
+            [0.0, 1.0, 0.0],
+            [0.0, 2.0, 0.0],
+        ])
+        b = np.array([2.0, 3.0, 1.0, 0.5])
+        for lb, ub in (
+            ([0.0, 0.0, 0.0], [50.0, 50.0, 50.0]),
+            ([1.0, 1.0, 0.0], [50.0, 50.0, 50.0]),
+            ([0.0, 0.0, 0.0], [0.5, 0.1, 50.0]),
+            ([0.0, 0.3, 0.0], [50.0, 0.31, 50.0]),
+        ):
+            with self.subTest(lb=lb, ub=ub):
+                lb, ub = np.array(lb), np.array(ub)
+                x, success = _searcher.solve_bounded_lsq(a.T @ a, a.T @ b, lb, ub)
+                expected = lsq_linear(a, b, bounds=(lb, ub), method='bvls')
+                self.assertTrue(success)
+                self.assertTrue(np.all(x >= lb) and np.all(x <= ub))
+                self.assertAlmostEqual(np.linalg.norm(a @ x - b), np.linalg.norm(expected.fun), places=9)
+
+        # should support fixed variables (lb == ub)
+        x, success = _searcher.solve_bounded_lsq(a.T @ a, a.T @ b, np.array([0.0, 0.3, 0.0]), np.array([50.0, 0.3, 50.0]))
+        self.assertTrue(success)
+        self.assertEqual(x[1], 0.3)
+
+    def test_calculate_gram_delta(self):
+        rng = np.random.default_rng(0)
+        a = rng.random((6, 3))
+        b = rng.random(6)
+        for x in (np.zeros(3), np.array([1.0, 0.5, 2.0])):
+            self.assertAlmostEqual(
+                _searcher.calculate_gram_delta(x, a.T @ a, a.T @ b, b @ b),
+                np.linalg.norm(a @ x - b),
+                places=9,
+            )
+
 
 class TestFormulaDatabase(unittest.TestCase):
     def test_from_file(self):
@@ -86,6 +127,19 @@ class TestFormulaDatabase(unittest.TestCase):
             },
         })
 
+    def test_herb_formulas(self):
+        database = _searcher.FormulaDatabase({
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '甲單方': {'甲藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+        })
+        self.assertEqual(database.herb_formulas, {
+            '甲藥': ['甲複方', '甲單方'],
+            '乙藥': ['甲複方', '乙複方'],
+            '丙藥': ['乙複方'],
+        })
+        self.assertEqual(database.formula_order, {'甲複方': 0, '甲單方': 1, '乙複方': 2})
+
 
 class TestExhaustiveFormulaSearcher(unittest.TestCase):
     @classmethod
@@ -315,6 +369,192 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         searcher._set_context(target_composition, penalty_factor=4.0)
         self.assertEqual(searcher.calculate_delta([1], ('甲複方',)), 4.0)
 
+    def test_get_remaining_amounts(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+            '丙複方': {'丁藥': 1.0},
+        }
+        target_composition = {'甲藥': 3.0, '乙藥': 2.0, '丙藥': 1.0}
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition)
+        np.testing.assert_allclose(searcher.get_remaining_amounts(('甲複方', '乙複方'), [1.0, 0.5]), [2.0, 0.5, 0.5])
+        np.testing.assert_allclose(searcher.get_remaining_amounts((), ()), [3.0, 2.0, 1.0])
+
+        # formulas not related to the target should also be supported
+        np.testing.assert_allclose(searcher.get_remaining_amounts(('甲複方', '丙複方'), [1.0, 2.0]), [2.0, 1.0, 1.0])
+
+    def test_build_dosage_system(self):
+        """||ax - b|| should equal the delta calculated by `calculate_delta`."""
+        database = {
+            '桂枝湯': {'桂枝': 0.6, '白芍': 0.6, '生薑': 0.6, '大棗': 0.5, '炙甘草': 0.4},
+            '麻黃湯': {'麻黃': 0.9, '桂枝': 0.6, '炙甘草': 0.3, '杏仁': 0.5},
+        }
+        target_composition = {'桂枝': 1.2, '白芍': 1.2, '生薑': 1.2, '大棗': 1.0, '炙甘草': 0.8}
+        combo = ('桂枝湯', '麻黃湯')
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition, penalty_factor=2.0)
+        a, b = searcher.build_dosage_system(combo)
+
+        self.assertEqual(a.shape, (7, 2))
+        np.testing.assert_allclose(b, [1.2, 1.2, 1.2, 1.0, 0.8, 0.0, 0.0])
+        np.testing.assert_allclose(a[5:, 1], [1.8, 1.0])
+        for x in ([1, 1], [2, 0], [0.5, 1.5]):
+            self.assertAlmostEqual(
+                np.linalg.norm(a @ np.array(x) - b),
+                searcher.calculate_delta(x, combo),
+                places=9,
+            )
+
+    def test_get_formula_bits(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '戊藥': 1.0},
+            '丙複方': {'戊藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 2.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition)
+        self.assertEqual(searcher.get_formula_bits('甲複方'), 0b011)
+        self.assertEqual(searcher.get_formula_bits('乙複方'), 0b010)
+        self.assertEqual(searcher.get_formula_bits('丙複方'), 0)
+
+    def test_calculate_delta_lower_bound(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+            '丙單方': {'丙藥': 1.0},
+            '丁單方': {'丁藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 2.0, '丁藥': 3.0, '戊藥': 4.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        # herbs without sformula (戊藥) always count
+        # uncovered herbs with sformula (丙藥, 丁藥) count except the largest max_sformulas ones
+        searcher._set_context(target_composition, max_sformulas=0)
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('甲複方',)), sqrt(2.0 ** 2 + 3.0 ** 2 + 4.0 ** 2))
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('乙複方',)), sqrt(1.0 ** 2 + 3.0 ** 2 + 4.0 ** 2))
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('甲複方', '乙複方')), sqrt(3.0 ** 2 + 4.0 ** 2))
+
+        searcher._set_context(target_composition, max_sformulas=1)
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('甲複方',)), sqrt(2.0 ** 2 + 4.0 ** 2))
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('甲複方', '乙複方')), 4.0)
+
+        searcher._set_context(target_composition, max_sformulas=2)
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(('甲複方',)), 4.0)
+        self.assertAlmostEqual(searcher.calculate_delta_lower_bound(()), sqrt(1.0 ** 2 + 1.0 ** 2 + 4.0 ** 2))
+
+    def test_generate_combinations_pruned(self):
+        """Should skip combos whose max match_pct cannot beat the current top_n matches."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 1.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        searcher._set_context(target_composition, top_n=1, max_cformulas=2, max_sformulas=0)
+        self.assertEqual(list(searcher.generate_combinations()), [
+            (), ('甲複方',), ('乙複方',), ('甲複方', '乙複方'),
+        ])
+
+        # max match_pct: () = 0%, ('乙複方',) = 29.29%
+        searcher._set_context(target_composition, top_n=1, max_cformulas=2, max_sformulas=0)
+        searcher.top_matches = [60.0]
+        self.assertEqual(list(searcher.generate_combinations()), [
+            ('甲複方',), ('甲複方', '乙複方'),
+        ])
+
+    def test_generate_combinations_pruned_by_min_dose(self):
+        """Should count the penalty of non-target herbs under the min cformula dose."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'甲藥': 1.0, '丙藥': 2.0},
+        }
+        target_composition = {'甲藥': 3.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        # max match_pct: ('乙複方',) = 100%
+        searcher._set_context(target_composition, top_n=1, min_cformula_dose=0.0)
+        searcher.top_matches = [0.0]
+        self.assertEqual(list(searcher.generate_combinations()), [
+            ('甲複方',), ('乙複方',), ('甲複方', '乙複方'),
+        ])
+
+        # max match_pct: ('甲複方',) = 33.33%, ('乙複方',) = -33.33%
+        searcher._set_context(target_composition, top_n=1, min_cformula_dose=1.0)
+        searcher.top_matches = [0.0]
+        self.assertEqual(list(searcher.generate_combinations()), [
+            ('甲複方',),
+        ])
+
+    def test_generate_combinations_pruned_by_min_dose_rounded(self):
+        """Should bound by the min cformula dose rounded down to places."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 0.5},
+        }
+        target_composition = {'甲藥': 0.3}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        # dosage 0.25 is reported as 0.2: match_pct = 25.46%
+        searcher._set_context(target_composition, top_n=1, min_cformula_dose=0.25, places=1)
+        self.assertEqual(searcher.evaluate_combination(('甲複方',))[1].tolist(), [0.2])
+        searcher.top_matches = [25.0]
+        self.assertEqual(list(searcher.generate_combinations()), [
+            ('甲複方',),
+        ])
+
+    @mock.patch.object(_searcher, 'log')
+    def test_generate_combinations_pruned_subtree(self, m_log):
+        """Should skip all combos with a prefix whose bound cannot beat the current top_n matches."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'甲藥': 1.0, '丙藥': 0.1},
+            '丙複方': {'甲藥': 1.0, '丁藥': 0.1},
+        }
+        target_composition = {'甲藥': 3.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        # max match_pct of any combo with ('甲複方',): 33.33%
+        searcher._set_context(target_composition, top_n=1, min_cformula_dose=1.0)
+        searcher.top_matches = [50.0]
+        self.assertEqual(list(searcher.generate_combinations()), [
+            ('乙複方',), ('丙複方',), ('乙複方', '丙複方'),
+        ])
+        m_log.debug.assert_any_call('剪枝子樹: %s', ('甲複方',))
+
+    def test_find_matches_for_combinations_reduced(self):
+        """Should skip a combo that reduces to an evaluated one after removing 0-dosage formulas."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 1.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition, max_sformulas=0)
+
+        matches = list(searcher.find_matches_for_combinations([('甲複方',), ('甲複方', '乙複方')]))
+        self.assertEqual([combo for _, combo, _ in matches], [('甲複方',)])
+
+    def test_is_prunable_extension(self):
+        """Should skip an extended combo whose max match_pct cannot beat the current top_n matches."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '丙單方': {'丙藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 1.0, '丁藥': 1.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        searcher._set_context(target_composition, top_n=1)
+        self.assertFalse(searcher._is_prunable_extension(('甲複方',)))
+
+        # max match_pct: ('甲複方', '丙單方') = 50%, ('甲複方',) = 29.29%
+        searcher.top_matches = [40.0]
+        self.assertFalse(searcher._is_prunable_extension(('甲複方', '丙單方')))
+        self.assertTrue(searcher._is_prunable_extension(('甲複方',)))
+
     def test_find_best_dosages(self):
         database = {
             '桂枝湯': {'桂枝': 0.6, '白芍': 0.6, '生薑': 0.6, '大棗': 0.5, '炙甘草': 0.4},
@@ -339,9 +579,27 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
             '桂枝': 1.2, '白芍': 1.2, '生薑': 1.2, '大棗': 1.0, '炙甘草': 0.8, '白朮': 1.0,
         }, penalty_factor=2.0)
         dosages, delta = searcher.find_best_dosages(['桂枝湯', '桂枝去芍藥湯'])
-        np.testing.assert_allclose(dosages, [1.997, 0.000], atol=1e-3)
+        np.testing.assert_allclose(dosages, [2.0, 0.0], atol=1e-3)
         self.assertAlmostEqual(delta, 1, places=3)
 
+    def test_find_best_dosages_single_formula(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+        }
+
+        # minimize (x - 2)^2 + (2x)^2 => x = 0.4
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context({'甲藥': 2.0}, penalty_factor=2.0)
+        dosages, delta = searcher.find_best_dosages(['甲複方'])
+        np.testing.assert_allclose(dosages, [0.4])
+        self.assertAlmostEqual(delta, sqrt(3.2))
+
+        # should be clipped to the bounds
+        searcher._set_context({'甲藥': 2.0}, penalty_factor=2.0, min_cformula_dose=1.0)
+        dosages, delta = searcher.find_best_dosages(['甲複方'])
+        np.testing.assert_allclose(dosages, [1.0])
+        self.assertAlmostEqual(delta, sqrt(5.0))
+
     def test_calculate_match_perfect_fit(self):
         """Should result in nearly 0 delta and 100% match_pct when combo can fit target perfectly."""
         database = {
@@ -409,6 +667,48 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         self.assertAlmostEqual(delta, 0.0, places=3)
         self.assertAlmostEqual(match_pct, 100.0, places=2)
 
+    def test_calculate_match_cached(self):
+        """Should reuse the cached result for the same set of formulas in any order."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'丙藥': 1.0, '丁藥': 1.0},
+        }
+        target_composition = {'甲藥': 2.0, '乙藥': 2.0, '丙藥': 3.0, '丁藥': 3.0}
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition, places=3)
+        dosages, delta, match_pct = searcher.calculate_match(('甲複方', '乙複方'))
+        np.testing.assert_allclose(dosages, [2.0, 3.0], atol=1e-3)
+
+        with mock.patch.object(searcher, '_calculate_match') as m_calc:
+            dosages2, delta2, match_pct2 = searcher.calculate_match(('乙複方', '甲複方'))
+            m_calc.assert_not_called()
+
+        np.testing.assert_allclose(dosages2, [3.0, 2.0], atol=1e-3)
+        self.assertEqual(delta2, delta)
+        self.assertEqual(match_pct2, match_pct)
+        self.assertEqual(searcher.evaluate_cache_hits, 1)
+        self.assertEqual(searcher.evaluate_cache_misses, 1)
+
+    @mock.patch.object(_searcher.FormulaSearcher, 'EVALUATE_CACHE_SIZE', 2)
+    def test_calculate_match_cache_bounded(self):
+        """Should evict the least recently used result when the cache is full."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'丙藥': 1.0, '丁藥': 1.0},
+        }
+        target_composition = {'甲藥': 2.0, '乙藥': 2.0, '丙藥': 3.0, '丁藥': 3.0}
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition)
+        searcher.calculate_match(('甲複方',))
+        searcher.calculate_match(('乙複方',))
+        searcher.calculate_match(('甲複方',))
+        searcher.calculate_match(('甲複方', '乙複方'))
+        self.assertEqual(list(searcher.evaluate_cache), [frozenset({'甲複方'}), frozenset({'甲複方', '乙複方'})])
+        self.assertEqual(searcher.evaluate_cache_hits, 1)
+        self.assertEqual(searcher.evaluate_cache_misses, 3)
+
     def test_evaluate_combination_basic(self):
         """Should return values as underlying `calculate_match` does."""
         database = {
@@ -502,6 +802,24 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         self.assertEqual(combo, ('桂枝去芍藥湯',))
         np.testing.assert_allclose(dosages, [2], atol=1e-3)
 
+    def test_find_best_matches_parallel(self):
+        """Should find the same matches as in a single process."""
+        target_composition = {
+            '桂枝': 1.2, '白芍': 1.2, '生薑': 1.2, '大棗': 1.0, '炙甘草': 0.8, '杏仁': 0.5,
+        }
+        searcher = _searcher.ExhaustiveFormulaSearcher(self.database)
+        expected = searcher.find_best_matches(10, target_composition, max_cformulas=2, max_sformulas=2)
+
+        with mock.patch.object(_searcher.ExhaustiveFormulaSearcher, 'CHUNK_SIZE', 2):
+            best_matches = searcher.find_best_matches(10, target_composition, max_cformulas=2, max_sformulas=2,
+                                                      workers=2)
+
+        # order of matches with same match_pct may vary
+        self.assertEqual(
+            {(round(match_pct, 3), frozenset(combo)) for match_pct, combo, _ in best_matches},
+            {(round(match_pct, 3), frozenset(combo)) for match_pct, combo, _ in expected},
+        )
+
 
 class TestBeamFormulaSearcher(unittest.TestCase):
     @staticmethod
@@ -651,7 +969,7 @@ class TestBeamFormulaSearcher(unittest.TestCase):
 
     def test_generate_combinations_beam_width(self):
         """Should pass items up to beam width in order of match_pct for each (non-last) depth."""
-        def se_eval(combo, *, initial_guess=None):
+        def se_eval(combo):
             return combo, (1.0,) * len(combo), 50.0 + 10 * len(combo)
 
         database, target_composition = self._sample_data()
@@ -922,15 +1240,25 @@ class TestBeamFormulaSearcher(unittest.TestCase):
             m_heur.assert_not_called()
 
     def _check_heuristic_scoring(self, database, target_composition, combo, dosages,
-                                 remaining_map, expected_scores, penalty_factor=1):
+                                 remaining_amounts, expected_scores, penalty_factor=1):
+        # only cformulas are scored; a zero-dose extra herb makes a single-herb
+        # formula a cformula without changing its score
+        database = {
+            formula: composition if len(composition) != 1 else {**composition, '無關藥': 0.0}
+            for formula, composition in database.items()
+        }
         searcher = _searcher.BeamFormulaSearcher(database)
         searcher._set_context(target_composition, penalty_factor=penalty_factor)
 
-        self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
+        np.testing.assert_allclose(searcher._calculate_remaining_amounts(combo, dosages), remaining_amounts)
 
+        scores = dict(zip(
+            searcher.cformula_names,
+            searcher._calculate_formula_scores(np.array(remaining_amounts, dtype=float)),
+        ))
         for formula, score in expected_scores.items():
             self.assertAlmostEqual(
-                searcher._calculate_formula_score(formula, remaining_map),
+                scores[formula],
                 score,
                 places=3,
                 msg=f'mismatching score for {formula!r}',
@@ -943,129 +1271,123 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         # identical composition ratios should be scored 1
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [1.0]
         expected_scores = {'甲複方': 1.000}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 2.0}}
         target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [1.0]
         expected_scores = {'甲複方': 1.000}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 2.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [2.0]
         expected_scores = {'甲複方': 1.000}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         # identical composition ratios should be scored 1
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0}
-        remaining_map = {'甲藥': 0.5, '乙藥': 0.5}
+        remaining_amounts = [1.0, 1.0]
         expected_scores = {'甲複方': 1.000}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         # half match
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0}
-        remaining_map = {'甲藥': 0.5, '乙藥': 0.5}
+        remaining_amounts = [1.0, 1.0]
         expected_scores = {'甲複方': 0.707}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 1.0, '丁藥': 1.0}
-        remaining_map = {'甲藥': 0.25, '乙藥': 0.25, '丙藥': 0.25, '丁藥': 0.25}
+        remaining_amounts = [1.0, 1.0, 1.0, 1.0]
         expected_scores = {'甲複方': 0.707}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         # thirds match
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 1.0}
-        remaining_map = {'甲藥': 1 / 3, '乙藥': 1 / 3, '丙藥': 1 / 3}
+        remaining_amounts = [1.0, 1.0, 1.0]
         expected_scores = {'甲複方': 0.577}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 2.0, '乙藥': 1.0}
-        remaining_map = {'甲藥': 2 / 3, '乙藥': 1 / 3}
+        remaining_amounts = [2.0, 1.0]
         expected_scores = {'甲複方': 0.894}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 2.0}
-        remaining_map = {'甲藥': 1 / 3, '乙藥': 2 / 3}
+        remaining_amounts = [1.0, 2.0]
         expected_scores = {'甲複方': 0.447}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         # quarter match
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 1.0, '丁藥': 1.0}
-        remaining_map = {'甲藥': 0.25, '乙藥': 0.25, '丙藥': 0.25, '丁藥': 0.25}
+        remaining_amounts = [1.0, 1.0, 1.0, 1.0]
         expected_scores = {'甲複方': 0.5}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 3.0, '乙藥': 1.0}
-        remaining_map = {'甲藥': 0.75, '乙藥': 0.25}
+        remaining_amounts = [3.0, 1.0]
         expected_scores = {'甲複方': 0.949}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 3.0}
-        remaining_map = {'甲藥': 0.25, '乙藥': 0.75}
+        remaining_amounts = [1.0, 3.0]
         expected_scores = {'甲複方': 0.316}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         # over match
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 1.0}}
         target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [1.0]
         expected_scores = {'甲複方': 0.707}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 1.0, '丙藥': 1.0, '丁藥': 1.0}}
         target_composition = {'甲藥': 1.0, '乙藥': 1.0}
-        remaining_map = {'甲藥': 0.5, '乙藥': 0.5}
+        remaining_amounts = [1.0, 1.0]
         expected_scores = {'甲複方': 0.707}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 3.0}}
         target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [1.0]
         expected_scores = {'甲複方': 0.316}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+                                      remaining_amounts, expected_scores)
 
-        # empty target should be scored 0
-        database = {'甲複方': {'甲藥': 1.0}}
-        target_composition = {}
-        remaining_map = {}
-        expected_scores = {'甲複方': 0.0}
-        self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+        # formulas unrelated to the target are never scored
+        searcher = _searcher.BeamFormulaSearcher({'甲複方': {'甲藥': 1.0}})
+        searcher._set_context({})
+        self.assertEqual(len(searcher._calculate_formula_scores(np.zeros(0))), 0)
 
-        # empty formula should be scored 0 (should not happen)
-        database = {'甲複方': {}}
-        target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
-        expected_scores = {'甲複方': 0.0}
-        self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores)
+        # empty formula is unrelated to any target (should not happen)
+        searcher = _searcher.BeamFormulaSearcher({'甲複方': {}})
+        searcher._set_context({'甲藥': 1.0})
+        self.assertEqual(len(searcher._calculate_formula_scores(np.ones(1))), 0)
 
     def test_generate_heuristic_candidates_scoring_with_penalty(self):
         combo = ()
@@ -1073,10 +1395,27 @@ class TestBeamFormulaSearcher(unittest.TestCase):
 
         database = {'甲複方': {'甲藥': 1.0, '乙藥': 1.0}}
         target_composition = {'甲藥': 1.0}
-        remaining_map = {'甲藥': 1.0}
+        remaining_amounts = [1.0]
         expected_scores = {'甲複方': 0.447}
         self._check_heuristic_scoring(database, target_composition, combo, dosages,
-                                      remaining_map, expected_scores, penalty_factor=2.0)
+                                      remaining_amounts, expected_scores, penalty_factor=2.0)
+
+    def test_calculate_formula_scores(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丁藥': 1.0},
+            '丙複方': {'甲藥': 2.0, '丙藥': 1.0},
+            '丁複方': {'丙藥': 1.0, '丁藥': 3.0},
+            '甲單方': {'甲藥': 3.0},
+        }
+        target_composition = {'甲藥': 4.0, '乙藥': 4.0, '丙藥': 2.0}
+        searcher = _searcher.BeamFormulaSearcher(database)
+        searcher._set_context(target_composition, penalty_factor=2.0)
+
+        # only cformulas are scored, in the order of cformula_names
+        scores = searcher._calculate_formula_scores(np.array([2.0, 0.0, 1.0]))
+        self.assertEqual(searcher.cformula_names, ('甲複方', '乙複方', '丙複方', '丁複方'))
+        np.testing.assert_allclose(scores, [0.632, 0.0, 1.0, 0.074], atol=1e-3)
 
     def test_generate_heuristic_candidates_single_main_herb(self):
         database = {
@@ -1092,18 +1431,15 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         searcher = _searcher.BeamFormulaSearcher(database)
         searcher._set_context(target_composition)
 
-        # check for expected remaining_map
-        remaining_map = {
-            '甲藥': np.float64(0.8),
-            '乙藥': np.float64(0.12),
-            '丙藥': np.float64(0.08),
-        }
-        self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
+        # check for expected remaining amounts
+        remaining_amounts = searcher._calculate_remaining_amounts(combo, dosages)
+        np.testing.assert_allclose(remaining_amounts, [10.0, 1.5, 1.0])
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('甲複方', remaining_map), 0.800, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.174, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.924, places=3)
+        scores = dict(zip(searcher.cformula_names, searcher._calculate_formula_scores(remaining_amounts)))
+        self.assertAlmostEqual(scores['甲複方'], 0.800, places=3)
+        self.assertAlmostEqual(scores['乙複方'], 0.174, places=3)
+        self.assertAlmostEqual(scores['丙複方'], 0.924, places=3)
 
         # check for expected order by scores
         # should limit generated item number within `quota`
@@ -1134,18 +1470,15 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         searcher = _searcher.BeamFormulaSearcher(database)
         searcher._set_context(target_composition)
 
-        # check for expected remaining_map
-        remaining_map = {
-            '甲藥': np.float64(0.4),
-            '乙藥': np.float64(0.4),
-            '丙藥': np.float64(0.2),
-        }
-        self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
+        # check for expected remaining amounts
+        remaining_amounts = searcher._calculate_remaining_amounts(combo, dosages)
+        np.testing.assert_allclose(remaining_amounts, [4.0, 4.0, 2.0])
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('甲複方', remaining_map), 0.943, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.707, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.745, places=3)
+        scores = dict(zip(searcher.cformula_names, searcher._calculate_formula_scores(remaining_amounts)))
+        self.assertAlmostEqual(scores['甲複方'], 0.943, places=3)
+        self.assertAlmostEqual(scores['乙複方'], 0.707, places=3)
+        self.assertAlmostEqual(scores['丙複方'], 0.745, places=3)
 
         # check for expected order by scores
         # should limit generated item number within `quota`
@@ -1175,17 +1508,14 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         searcher = _searcher.BeamFormulaSearcher(database)
         searcher._set_context(target_composition)
 
-        # check for expected remaining_map
-        # remaining dose = {'乙藥': 0.5, '丙藥': 1.0}
-        remaining_map = {
-            '乙藥': np.float64(0.3333333333333333),
-            '丙藥': np.float64(0.6666666666666666),
-        }
-        self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
+        # check for expected remaining amounts
+        remaining_amounts = searcher._calculate_remaining_amounts(combo, dosages)
+        np.testing.assert_allclose(remaining_amounts, [0.0, 0.5, 1.0])
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.800, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.632, places=3)
+        scores = dict(zip(searcher.cformula_names, searcher._calculate_formula_scores(remaining_amounts)))
+        self.assertAlmostEqual(scores['乙複方'], 0.800, places=3)
+        self.assertAlmostEqual(scores['丙複方'], 0.632, places=3)
 
         # check for expected order by scores
         # should limit generated item number within `quota`
@@ -1211,11 +1541,11 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         searcher = _searcher.BeamFormulaSearcher(database)
         searcher._set_context(target_composition)
 
-        # check for expected remaining_map
-        remaining_map = {}
-        self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
+        # check for expected remaining amounts
+        remaining_amounts = searcher._calculate_remaining_amounts(combo, dosages)
+        np.testing.assert_allclose(remaining_amounts, [0.0, 0.0])
 
-        # skip generating if remaining_map is empty
+        # skip generating if no remaining amount
         self.assertEqual(
             list(searcher.generate_heuristic_candidates(combo, dosages, quota=1)),
             [],